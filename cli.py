@@ -0,0 +1,18 @@
+import argparse
+
+
+def get_args():
+    parser = argparse.ArgumentParser(description="Compute temporal, spatial, and 3D entropy from Sentinel-2 index")
+
+    parser.add_argument("--index", type=str, default="NDVI", help="Index to process (NDVI, SAVI, EVI)")
+    parser.add_argument("--entropy", type=str, default="shannon", help="Entropy measure: shannon, renyi_0, renyi_2, rao_q")
+    parser.add_argument("--start", type=str, default="2023-06-01", help="Start date (YYYY-MM-DD)")
+    parser.add_argument("--end", type=str, default="2023-06-30", help="End date (YYYY-MM-DD)")
+    parser.add_argument("--frequency", type=str, default="10D", help="Temporal frequency (e.g. 10D, 1M for month starts)")
+    parser.add_argument("--geojson", type=str, default="AOI/AoI_France.json", help="Path to AOI GeoJSON file")
+    parser.add_argument("--bucket", type=str, default="gchm-predictions-test", help="GCS bucket name")
+    parser.add_argument("--input_folder", type=str, default="rasterdiv_map", help="Folder in bucket to store input datacube")
+    parser.add_argument("--entropy_folder", type=str, default="entropy", help="Folder in bucket to store entropy results")
+    parser.add_argument("--window_size", type=int, default=7, help="Sliding window size for spatial/3D entropy (odd number)")
+
+    return parser.parse_args()
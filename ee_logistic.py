@@ -1,51 +1,54 @@
 from google.cloud import storage
 import ee
-import json
 import os
-from datetime import datetime, timedelta
 import time
-import numpy as np
-import requests
-from io import BytesIO
-import shutil
-import rasterio
 import google.auth
 from google.oauth2 import service_account
-import argparse
+from concurrent.futures import ThreadPoolExecutor
 
+GCS_BATCH_SIZE = 100
+GCS_LIST_THRESHOLD = 32  # Above this many images, list the input folder once instead of one exists() per image
+EE_SCOPES = ['https://www.googleapis.com/auth/cloud-platform',
+             'https://www.googleapis.com/auth/earthengine']
 
-def get_args():
-    parser = argparse.ArgumentParser(description="Compute temporal, spatial, and 3D entropy from Sentinel-2 index")
+# High-volume endpoint: higher request quota for automated getDownloadURL / getInfo workloads
+EE_HIGHVOLUME_URL = "https://earthengine-highvolume.googleapis.com"
 
-    parser.add_argument("--index", type=str, default="NDVI", help="Index to process (NDVI, SAVI, EVI)")
-    parser.add_argument("--entropy", type=str, default="shannon", help="Entropy measure: shannon, renyi_0, renyi_2, rao_q")
-    parser.add_argument("--start", type=str, default="2023-06-01", help="Start date (YYYY-MM-DD)")
-    parser.add_argument("--end", type=str, default="2023-06-30", help="End date (YYYY-MM-DD)")
-    parser.add_argument("--frequency", type=str, default="10D", help="Temporal frequency (e.g. 10D, 1M)")
-    parser.add_argument("--geojson", type=str, default="AOI/AoI_France.json", help="Path to AOI GeoJSON file")
-    parser.add_argument("--bucket", type=str, default="gchm-predictions-test", help="GCS bucket name")
-    parser.add_argument("--input_folder", type=str, default="rasterdiv_map", help="Folder in bucket to store input datacube")
-    parser.add_argument("--entropy_folder", type=str, default="entropy", help="Folder in bucket to store entropy results")
-    parser.add_argument("--window_size", type=int, default=7, help="Sliding window size for spatial/3D entropy (odd number)")
-
-    return parser.parse_args()
+_CREDENTIALS = {}  # Cached by initialize_gee, keyed by service account key path (None for default credentials)
 
 
+def initialize_gee(service_account_key_path=None, project_id="canopy-height-model-00", use_default=None,
+                   opt_url=EE_HIGHVOLUME_URL):
+    """
+    Initialise Google Earth Engine et force l'utilisation du projet.
 
-def initialize_gee(service_account_key_path, project_id="canopy-height-model-00"):
-    """Initialise Google Earth Engine avec un fichier JSON de compte de service et force l'utilisation du projet."""
+    Uses google.auth.default() (GCE / Cloud Run metadata, no file IO) when use_default is True
+    or no key file is given, otherwise the service account JSON file. Credentials are cached at
+    module level per key path, so repeated calls in the same process skip the JSON parse and key setup.
+    Requests go to the high-volume endpoint by default (opt_url=None for the standard one).
+    """
     try:
         os.environ['GOOGLE_CLOUD_PROJECT'] = project_id
 
-        credentials = service_account.Credentials.from_service_account_file(
-            service_account_key_path,
-            scopes=['https://www.googleapis.com/auth/cloud-platform',
-                    'https://www.googleapis.com/auth/earthengine']
-        )
-
-        ee.Initialize(credentials, project=project_id)
-
-        print(f"✅ Earth Engine initialized successfully with service account: {credentials.service_account_email}")
+        if use_default or (use_default is None and service_account_key_path is None):
+            cache_key = None
+        else:
+            cache_key = service_account_key_path
+
+        if cache_key not in _CREDENTIALS:
+            if cache_key is None:
+                _CREDENTIALS[cache_key], _ = google.auth.default(scopes=EE_SCOPES)
+            else:
+                _CREDENTIALS[cache_key] = service_account.Credentials.from_service_account_file(
+                    service_account_key_path,
+                    scopes=EE_SCOPES
+                )
+        credentials = _CREDENTIALS[cache_key]
+
+        ee.Initialize(credentials, project=project_id, opt_url=opt_url)
+
+        account = getattr(credentials, "service_account_email", "application default credentials")
+        print(f"✅ Earth Engine initialized successfully with service account: {account}")
         print(f"📢 Projet used for Earth Engine : {project_id}")
 
     except Exception as e:
@@ -53,9 +56,9 @@ def initialize_gee(service_account_key_path, project_id="canopy-height-model-00"
 
 
 
-def export_image_to_gcs(image,folder, file_name, bucket_name, polygon):
-    """ Exporte l'image vers GCS dans le dossier DATASET_GEE_TIF/ et attend la fin du traitement."""
-    
+def start_export(image, folder, file_name, bucket_name, polygon):
+    """Lance l'export de l'image vers GCS et renvoie la tâche sans attendre la fin du traitement."""
+
     # On stocke les images dans le dossier "rasterdiv/" du bucket
     file_path = f"{folder}/{file_name}"
 
@@ -68,70 +71,139 @@ def export_image_to_gcs(image,folder, file_name, bucket_name, polygon):
         region=polygon,
         crs='EPSG:4326',
         fileFormat='GeoTIFF',
+        formatOptions={'cloudOptimized': True},  # Tiled COG with overviews for windowed reads
         maxPixels=1e9
     )
-   
 
-    # Afficher le compte de service utilisé par GEE
     task.start()
+    print(f"📤 Exporting {file_name} to gs://{bucket_name}/{file_path}...")
+
+    return task
 
-    # Attendre la fin de l'exportation
-    while task.active():
-        print(f"📤 Exporting {file_name} to gs://{bucket_name}/{file_path}...")
-        time.sleep(30)  # Pause de 30 secondes avant de revérifier
-    
-    print(f"✅ Export of {file_name} completed to gs://{bucket_name}/{file_path}.")
 
-def save_as_geotiff(output_path, raster_array, meta):
+def wait_all(tasks, max_poll_interval=30):
     """
-    Saves a raster array as a GeoTIFF file.
+    Waits until every Earth Engine task in the list has finished.
+
+    Status requests are issued concurrently so that N exports running in
+    parallel on GEE are polled in a single round. The delay between rounds
+    grows exponentially (2, 4, 8, 16, 30, 30, ... s) so short exports are
+    picked up quickly.
 
     Parameters:
-    - output_path: str, file path to save the GeoTIFF.
-    - raster_array: np.array, computed raster (e.g., entropy result).
-    - meta: dict, metadata from the original raster (crs, transform, etc.).
+    - tasks: list of ee.batch.Task, started export tasks
+    - max_poll_interval: int, upper bound in seconds between two status rounds
 
     Returns:
-    - None (saves file to disk).
+    - dict mapping each task description to its final state
+
+    Raises:
+    - RuntimeError if any task ends FAILED or CANCELLED (after all tasks have finished)
     """
-    with rasterio.open(
-        output_path, "w",
-        driver="GTiff",
-        height=raster_array.shape[0],
-        width=raster_array.shape[1],
-        count=1,  # Single-band output
-        dtype=rasterio.float32,  # Ensure floating-point precision
-        crs=meta["crs"],  # Keep original coordinate system
-        transform=meta["transform"]  # Keep original georeferencing
-    ) as dst:
-        dst.write(raster_array, 1)
+    finished_states = {"COMPLETED", "FAILED", "CANCELLED"}
+    pending = list(tasks)
+    results = {}
+    errors = []
+    delay = 2
+
+    with ThreadPoolExecutor(max_workers=16) as executor:
+        while pending:
+            statuses = list(executor.map(lambda task: task.status(), pending))
+
+            still_running = []
+            for task, status in zip(pending, statuses):
+                state = status["state"]
+                if state not in finished_states:
+                    still_running.append(task)
+                    continue
+
+                results[status["description"]] = state
+                if state == "COMPLETED":
+                    print(f"✅ Export of {status['description']} completed.")
+                else:
+                    print(f"❌ Export of {status['description']} {state}: {status.get('error_message', '')}")
+                    errors.append(f"{status['description']} {state}: {status.get('error_message', '')}")
+
+            pending = still_running
+            if pending:
+                print(f"⏳ {len(pending)} export(s) still running...")
+                time.sleep(delay)
+                delay = min(max_poll_interval, delay * 2)
+
+    if errors:
+        raise RuntimeError(f"❌ {len(errors)} export(s) did not complete: " + "; ".join(errors))
+
+    return results
+
+
+def export_image_to_gcs(image, folder, file_name, bucket_name, polygon):
+    """ Exporte l'image vers GCS dans le dossier DATASET_GEE_TIF/ et attend la fin du traitement."""
+    task = start_export(image, folder, file_name, bucket_name, polygon)
+    wait_all([task])
+    return task
 
-    print(f"✅ Raster saved as {output_path}")
+def move_images_after_analysis(image_names, input_folder, output_folder, bucket_name):
+    """
+    Moves a list of images from the input folder to the output folder in GCS after processing.
 
+    Objects are copied server-side with rewrite (no download, works for large rasters),
+    in parallel, then the originals are deleted through batched requests. Source images are
+    looked up with one exists() call each, or with a single listing of input_folder when
+    there are more than GCS_LIST_THRESHOLD of them.
 
-def move_image_after_analysis(image_name, input_folder, output_folder, bucket_name):
-    """Moves an image from the specified input folder to the output folder in GCS after processing."""
+    Parameters:
+    - image_names: list of str, file names inside input_folder
+    - input_folder: str, source folder in the bucket
+    - output_folder: str, destination folder in the bucket
+    - bucket_name: str, GCS bucket name
 
+    Returns:
+    - None
+    """
     storage_client = storage.Client()
     bucket = storage_client.bucket(bucket_name)
 
-    # ✅ Use specified input and output folders
-    source_blob_name = f"{input_folder}/{image_name}"  
-    destination_blob_name = f"{output_folder}/{image_name}"  
+    source_blob_names = [f"{input_folder}/{image_name}" for image_name in image_names]
+    if len(source_blob_names) > GCS_LIST_THRESHOLD:
+        # ✅ Many images: list the input folder once instead of checking each blob separately
+        existing_blobs = {blob.name for blob in bucket.list_blobs(prefix=f"{input_folder}/")}
+    else:
+        # ✅ Few images: check the named blobs directly, the folder may hold many more objects
+        with ThreadPoolExecutor(max_workers=16) as executor:
+            found = list(executor.map(lambda name: bucket.blob(name).exists(), source_blob_names))
+        existing_blobs = {name for name, exists in zip(source_blob_names, found) if exists}
+
+    moves = []
+    for image_name in image_names:
+        source_blob_name = f"{input_folder}/{image_name}"
+        destination_blob_name = f"{output_folder}/{image_name}"
+
+        if source_blob_name not in existing_blobs:
+            print(f"❌ Image {source_blob_name} not found in GCS bucket {bucket_name}.")
+            continue
 
-    # ✅ Check if the file exists in GCS before moving
-    source_blob = bucket.blob(source_blob_name)
-    if not source_blob.exists():
-        print(f"❌ Image {source_blob_name} not found in GCS bucket {bucket_name}.")
-        return
+        moves.append((bucket.blob(source_blob_name), bucket.blob(destination_blob_name)))
 
-    # ✅ Copy the image to the new folder
-    bucket.copy_blob(source_blob, bucket, new_name=destination_blob_name)
+    def rewrite(move):
+        source_blob, destination_blob = move
+        token, _, _ = destination_blob.rewrite(source_blob)
+        while token is not None:  # Large objects are copied in several calls
+            token, _, _ = destination_blob.rewrite(source_blob, token=token)
 
-    # ✅ Delete the original file to prevent duplication
-    source_blob.delete()
+    # ✅ Copy the images to the new folder
+    with ThreadPoolExecutor(max_workers=16) as executor:
+        list(executor.map(rewrite, moves))
 
-    print(f"✅ Image moved from gs://{bucket_name}/{source_blob_name} to gs://{bucket_name}/{destination_blob_name}")
+    # ✅ Delete the original files to prevent duplication (GCS batches are limited to 100 calls)
+    for start in range(0, len(moves), GCS_BATCH_SIZE):
+        with storage_client.batch():
+            for source_blob, _ in moves[start:start + GCS_BATCH_SIZE]:
+                source_blob.delete()
 
+    for source_blob, destination_blob in moves:
+        print(f"✅ Image moved from gs://{bucket_name}/{source_blob.name} to gs://{bucket_name}/{destination_blob.name}")
 
 
+def move_image_after_analysis(image_name, input_folder, output_folder, bucket_name):
+    """Moves an image from the specified input folder to the output folder in GCS after processing."""
+    move_images_after_analysis([image_name], input_folder, output_folder, bucket_name)
@@ -1,12 +1,13 @@
-import json  
+import orjson
 import ee  
 import numpy as np  
-import requests 
-from io import BytesIO  
-from datetime import datetime, timedelta  
+from datetime import timedelta  
 from google.cloud import storage  
 import pandas as pd
 
+DLC_NODATA = -9999  # Value of DLC-masked pixels in exported data cubes
+S2_BANDS = ["B2", "B3", "B4", "B8", "B11", "B12"]  # Sentinel-2 bands kept in composites
+
 def load_and_validate_geojson(bucket_name, geojson_path):
     """Charge et valide un fichier GeoJSON depuis un bucket Google Cloud Storage."""
     
@@ -15,28 +16,44 @@ def load_and_validate_geojson(bucket_name, geojson_path):
     bucket = storage_client.bucket(bucket_name)
     blob = bucket.blob(geojson_path)
 
-    # ✅ Télécharger le fichier GeoJSON dans une variable
-    geojson_data = blob.download_as_text()
-    geojson = json.loads(geojson_data)
+    # ✅ Télécharger le fichier GeoJSON (octets bruts, sans décodage UTF-8) et le parser avec orjson
+    geojson = orjson.loads(blob.download_as_bytes())
 
     # ✅ Extraire la géométrie du premier feature et la convertir en Geometry GEE
-    return ee.Geometry.Polygon(geojson['features'][0]['geometry']['coordinates'])
+    coords = geojson['features'][0]['geometry']['coordinates']
+    return ee.Geometry.Polygon(coords), np.asarray(coords[0], dtype=float)
 
 def get_square_encompassing_polygon(polygon):
-    """Generate a square that fully encompasses the given polygon."""
-    bounds = polygon.bounds().coordinates().getInfo()[0]
-    
-    min_x = min([p[0] for p in bounds])
-    max_x = max([p[0] for p in bounds])
-    min_y = min([p[1] for p in bounds])
-    max_y = max([p[1] for p in bounds])
+    """Generate a square that fully encompasses the given polygon, built server-side (no getInfo)."""
+    bounds = ee.List(polygon.bounds().coordinates().get(0))
+    xs = bounds.map(lambda p: ee.List(p).get(0))
+    ys = bounds.map(lambda p: ee.List(p).get(1))
+
+    min_x = ee.Number(xs.reduce(ee.Reducer.min()))
+    max_x = ee.Number(xs.reduce(ee.Reducer.max()))
+    min_y = ee.Number(ys.reduce(ee.Reducer.min()))
+    max_y = ee.Number(ys.reduce(ee.Reducer.max()))
+
+    width = max_x.subtract(min_x)
+    height = max_y.subtract(min_y)
+    half_side = width.max(height).divide(2)
 
-    width = max_x - min_x
-    height = max_y - min_y
-    side = max(width, height)
+    center_x = min_x.add(max_x).divide(2)
+    center_y = min_y.add(max_y).divide(2)
 
-    center_x = (min_x + max_x) / 2
-    center_y = (min_y + max_y) / 2
+    return ee.Geometry.Rectangle([
+        center_x.subtract(half_side), center_y.subtract(half_side),
+        center_x.add(half_side), center_y.add(half_side)
+    ])
+
+
+def get_square_encompassing_polygon_from_coords(ring):
+    """Generate a square that fully encompasses the polygon outer ring (N x 2 array), computed locally (no getInfo)."""
+    arr = np.asarray(ring, dtype=float)
+    mins = arr.min(axis=0)
+    maxs = arr.max(axis=0)
+    side = (maxs - mins).max()
+    center_x, center_y = (mins + maxs) / 2
 
     square_coords = [
         [center_x - side / 2, center_y - side / 2],
@@ -50,25 +67,76 @@ def get_square_encompassing_polygon(polygon):
 
 
 
-def create_composite(start_date, aoi, cloud_percentage=50):
-    """Create a composite with lower cloud coverage."""
-    start_date_obj = datetime.strptime(start_date, "%Y-%m-%d")
-    end_date_obj = start_date_obj + timedelta(days=90)
-    end_date = end_date_obj.strftime("%Y-%m-%d")
-    
-    collection = (ee.ImageCollection('COPERNICUS/S2_SR_HARMONIZED')
-                  .filterBounds(aoi)
-                  .filterDate(start_date, end_date)
-                  .filter(ee.Filter.lt('CLOUDY_PIXEL_PERCENTAGE', cloud_percentage)))
-    
-    sorted_collection = collection.sort('CLOUDY_PIXEL_PERCENTAGE')
-    lowest_cloud_images = sorted_collection.limit(3)
-    
-    return lowest_cloud_images.median().toFloat()  # ✅ Ensure output is Float32
+def build_filtered_s2(aoi, start_date, end_date, cloud_percentage=50):
+    """
+    Builds the Sentinel-2 collection shared by every composite of a data cube.
+
+    Bounds, date window and cloud filters are applied once at collection level;
+    each composite then only slices its own 90-day window out of it. Every image
+    gets a "cscore" band (100 - CLOUDY_PIXEL_PERCENTAGE), masked to the scene footprint, for qualityMosaic.
+
+    Parameters:
+    - aoi: ee.Geometry, area of interest
+    - start_date: str, first composite date ("YYYY-MM-DD")
+    - end_date: str, end of the data cube period ("YYYY-MM-DD"), extended by 90 days to cover the last window
+    - cloud_percentage: int, maximum CLOUDY_PIXEL_PERCENTAGE kept
+
+    Returns:
+    - An ee.ImageCollection filtered on the AOI, dates and cloud cover, with a "cscore" band.
+    """
+    def add_cloud_score(image):
+        cloud_score = ee.Image.constant(100).subtract(ee.Number(image.get('CLOUDY_PIXEL_PERCENTAGE')))
+        # Score only where the scene has data, so qualityMosaic never picks it outside its footprint
+        footprint = image.select(S2_BANDS).mask().reduce(ee.Reducer.min())
+        return image.addBands(cloud_score.toFloat().updateMask(footprint).rename('cscore'))
+
+    return (ee.ImageCollection('COPERNICUS/S2_SR_HARMONIZED')
+            .filterBounds(aoi)
+            .filterDate(ee.Date(start_date), ee.Date(end_date).advance(90, 'day'))
+            .filter(ee.Filter.lt('CLOUDY_PIXEL_PERCENTAGE', cloud_percentage))
+            .map(add_cloud_score))
+
+
+def create_composite(start_date, base_collection):
+    """Create a composite with lower cloud coverage from a collection built by build_filtered_s2. start_date can be a "YYYY-MM-DD" string or a server-side value."""
+    start = ee.Date(start_date)
+    end = start.advance(90, 'day')
+
+    collection = base_collection.filterDate(start, end)
+
+    # Per pixel, keep the valid observation from the least cloudy scene (no sort + limit)
+    composite = collection.qualityMosaic('cscore').select(S2_BANDS)
+
+    return composite.toFloat()  # ✅ Ensure output is Float32
+
+
+# Sentinel-2 band aliases used in the index expressions
+INDEX_BANDS = {"BLUE": "B2", "GREEN": "B3", "RED": "B4", "NIR": "B8"}
+
+# Index formulas, in output band order
+INDEX_EXPRESSIONS = {
+    # NDVI = (NIR - Red) / (NIR + Red)
+    "NDVI": "(NIR - RED) / (NIR + RED)",
+    # NDWI = (Green - NIR) / (Green + NIR)
+    "NDWI": "(GREEN - NIR) / (GREEN + NIR)",
+    # SAVI = ((NIR - Red) / (NIR + Red + L)) * (1 + L)  (L = 0.5 by default)
+    "SAVI": "((NIR - RED) / (NIR + RED + 0.5)) * (1.5)",
+    # EVI = (G * (NIR - Red)) / (NIR + (C1 * Red) - (C2 * Blue) + L)  (G = 2.5, C1 = 6, C2 = 7.5, L = 1)
+    "EVI": "(2.5 * (NIR - RED)) / (NIR + (6.0 * RED) - (7.5 * BLUE) + 1.0)",
+    # MSAVI = (2 * NIR + 1 - sqrt((2 * NIR + 1)^2 - 8 * (NIR - Red))) / 2
+    "MSAVI": "(2 * NIR + 1 - sqrt((2 * NIR + 1) ** 2 - 8 * (NIR - RED))) / 2",
+    # BAI = (B - NIR) / (B + NIR)  (custom formula)
+    "BAI": "(BLUE - NIR) / (BLUE + NIR)",
+}
+
+
 def compute_indices(image, indices=["NDVI", "NDWI", "SAVI", "EVI", "MSAVI", "BAI"]):
     """
     Computes multiple vegetation indices and returns only the selected ones.
 
+    Every index is an expression over the same band aliases, assembled into one
+    image so that Earth Engine evaluates them together in a single pass per tile.
+
     Parameters:
     - image: ee.Image (Sentinel-2 composite)
     - indices: list of indices to compute ["NDVI", "NDWI", "SAVI", "EVI", "MSAVI", "BAI"]
@@ -76,65 +144,37 @@ def compute_indices(image, indices=["NDVI", "NDWI", "SAVI", "EVI", "MSAVI", "BAI
     Returns:
     - An ee.Image containing only the selected indices.
     """
+    # Select each input band once; every expression reuses the same handles
+    band_images = {alias: image.select(band) for alias, band in INDEX_BANDS.items()}
+
     bands = []
+    for name, expression in INDEX_EXPRESSIONS.items():
+        if name not in indices:
+            continue
+        band_map = {alias: band_image for alias, band_image in band_images.items() if alias in expression}
+        bands.append(image.expression(expression, band_map).rename(name))
 
-    # NDVI = (NIR - Red) / (NIR + Red)
-    if "NDVI" in indices:
-        ndvi = image.normalizedDifference(["B8", "B4"]).rename("NDVI")
-        bands.append(ndvi)
+    # Combine all selected indices into a single image
+    return ee.Image.cat(bands).toFloat()
 
-    # NDWI = (NIR - SWIR) / (NIR + SWIR)
-    if "NDWI" in indices:
-        ndwi = image.normalizedDifference(["B3", "B8"]).rename("NDWI")
-        bands.append(ndwi)
 
-    # SAVI = ((NIR - Red) / (NIR + Red + L)) * (1 + L)  (L = 0.5 by default)
-    if "SAVI" in indices:
-        savi = image.expression(
-            "((NIR - RED) / (NIR + RED + 0.5)) * (1.5)", {
-                "NIR": image.select("B8"),
-                "RED": image.select("B4")
-            }).rename("SAVI")
-        bands.append(savi)
-
-    # EVI = (G * (NIR - Red)) / (NIR + (C1 * Red) - (C2 * Blue) + L)
-    if "EVI" in indices:
-        evi = image.expression(
-            "(G * (NIR - RED)) / (NIR + (C1 * RED) - (C2 * BLUE) + L)", {
-                "NIR": image.select("B8"),
-                "RED": image.select("B4"),
-                "BLUE": image.select("B2"),
-                "G": 2.5,  # Gain factor
-                "C1": 6.0,  # Coefficient for RED
-                "C2": 7.5,  # Coefficient for BLUE
-                "L": 1.0  # Soil adjustment factor
-            }).rename("EVI")
-        bands.append(evi)
 
-    # MSAVI = (2 * NIR + 1 - sqrt((2 * NIR + 1)^2 - 8 * (NIR - Red))) / 2
-    if "MSAVI" in indices:
-        msavi = image.expression(
-            "(2 * NIR + 1 - sqrt((2 * NIR + 1) ** 2 - 8 * (NIR - RED))) / 2", {
-                "NIR": image.select("B8"),
-                "RED": image.select("B4")
-            }).rename("MSAVI")
-        bands.append(msavi)
+def generate_dates(start_date, end_date, period="10D"):
+    """
+    Dates of the time series, one every period from start_date to end_date (inclusive).
 
-    # BAI = (B - NIR) / (B + NIR)  (custom formula)
-    if "BAI" in indices:
-        bai = image.expression(
-            "(BLUE - NIR) / (BLUE + NIR)", {
-                "BLUE": image.select("B2"),
-                "NIR": image.select("B8")
-            }).rename("BAI")
-        bands.append(bai)
+    pandas reads "M" as month end (and pandas >= 3 rejects it): monthly periods such as
+    "1M" or "3M" are mapped to "MS", so the dates fall on month starts.
 
-    # Combine all selected indices into a single image
-    return ee.Image(bands).toFloat()
+    Returns:
+    - pd.DatetimeIndex
+    """
+    if period == "M" or (period.endswith("M") and period[:-1].isdigit()):
+        period = period + "S"
+    return pd.date_range(start=start_date, end=end_date, freq=period)
 
-    
 
-def create_data_cube(aoi, start_date, end_date, period="10D", indices=["NDVI"]):
+def create_data_cube(aoi, start_date, end_date, period="10D", indices=["NDVI"], dlc_masks=None, as_stack=False):
     """
     Creates a time-series data cube containing selected indices and/or Sentinel-2 bands.
 
@@ -142,35 +182,29 @@ def create_data_cube(aoi, start_date, end_date, period="10D", indices=["NDVI"]):
     - aoi: ee.Geometry, area of interest
     - start_date: str, start date ("YYYY-MM-DD")
     - end_date: str, end date ("YYYY-MM-DD")
-    - period: str, acquisition frequency ("10D", "1M" for monthly)
+    - period: str, acquisition frequency ("10D", "1M" for monthly, on month starts)
     - indices: list of indices and/or "S2" to include raw Sentinel-2 bands
+    - dlc_masks: dict {date: ee.Image} from get_dlc_mask, applied server-side (masked pixels set to DLC_NODATA)
+    - as_stack: bool, return a single multi-band ee.Image (one band per date and index) instead of a collection
 
     Returns:
-    - An ee.ImageCollection representing the temporal data cube.
+    - An ee.ImageCollection representing the temporal data cube, or an ee.Image if as_stack is True.
     """
-    # Convert date strings to datetime objects
-    start = datetime.strptime(start_date, "%Y-%m-%d")
-    end = datetime.strptime(end_date, "%Y-%m-%d")
-
-    # Generate a list of dates at the chosen frequency
-    dates = []
-    current_date = start
-    while current_date <= end:
-        dates.append(current_date.strftime("%Y-%m-%d"))
-        if "D" in period:
-            days = int(period.replace("D", ""))
-            current_date += timedelta(days=days)
-        elif "M" in period:
-            current_date += timedelta(days=30)  # Approximate monthly interval
+    # Generate a list of dates at the chosen frequency (same dates as get_dlc_mask)
+    dates = generate_dates(start_date, end_date, period).strftime("%Y-%m-%d").tolist()
+
+    masks = ee.Dictionary(dlc_masks) if dlc_masks else None
+
+    # Filter the S2 archive once for the whole period; composites only slice it by date
+    s2_collection = build_filtered_s2(aoi, start_date, end_date)
 
     # Build the data cube by computing indices and/or including Sentinel-2 bands
-    cube = []
-    for date in dates:
-        composite = create_composite(date, aoi)  # Generate composite for the given date
+    def build_one(date):
+        composite = create_composite(date, s2_collection)  # Generate composite for the given date
 
         # If "S2" is in the indices list, include raw Sentinel-2 bands
         if "S2" in indices:
-            s2_bands = composite.select(["B2", "B3", "B4", "B8", "B11", "B12"])  # Key S2 bands
+            s2_bands = composite.select(S2_BANDS)  # Key S2 bands
         else:
             s2_bands = None
 
@@ -191,92 +225,58 @@ def create_data_cube(aoi, start_date, end_date, period="10D", indices=["NDVI"]):
         else:
             final_image = None  # Should never happen
 
-        if final_image:
-            cube.append(final_image)
+        if final_image and masks is not None:
+            # Masked pixels get a nodata value instead of 0, so entropy kernels can tell them from real zeros
+            final_image = final_image.updateMask(ee.Image(masks.get(date, ee.Image(1)))).unmask(DLC_NODATA).toFloat()
+
+        return final_image
+
+    # build_one is traced once and mapped over the date list server-side: a single graph for the whole cube
+    cube = ee.ImageCollection(ee.List(dates).map(build_one))
+
+    if as_stack:
+        return cube.toBands()
+
+    return cube
+
+
+def build_esa_mask(aoi):
+    """Binary ESA WorldCover mask (1 = kept, 0 = excluded) as an ee.Image. Excludes built + bare."""
+    esa_image = ee.ImageCollection("ESA/WorldCover/v200").first().clip(aoi)
+    exclude_classes = [50, 60]  # 50 = Urban, 60 = Bare Sparse Vegetation
+    # Single remap pass: excluded classes -> 0, everything else -> 1
+    return esa_image.select("Map").remap(exclude_classes, [0] * len(exclude_classes), 1).rename("mask")
 
-    return ee.ImageCollection(cube)
 
+def build_dw_mask(dw_image, aoi):
+    """Binary Dynamic World mask (1 = kept, 0 = excluded) as an ee.Image."""
+    dw_image = dw_image.clip(aoi)
 
-def get_dlc_mask_numpy(aoi, start_date, end_date, period="10D"):
+    # ❌ Only exclude built area and bare ground (6 & 7)
+    exclude = [6, 7]
+    return dw_image.select("label").remap(exclude, [0] * len(exclude), 1).rename("mask")
+
+
+def get_dlc_mask(aoi, start_date, end_date, period="10D"):
     """
-    Retrieves land cover masks (DLC) as NumPy arrays for each date.
+    Builds land cover masks (DLC) as ee.Image objects for each date, kept server-side.
     Keeps only classes relevant for biodiversity (trees, grass, crops, shrubs, etc.).
-    Excludes built areas and bare ground. Falls back to ESA WorldCover if DW unavailable.
+    Falls back to ESA WorldCover when no Dynamic World image exists for the date.
+
+    Returns:
+    - dict {date_str: ee.Image}, to be applied to the index images before export
     """
     masks = {}
-    dates = pd.date_range(start=start_date, end=end_date, freq=period)
-
-    # Load ESA fallback (exclude built + bare)
-    esa_mask_numeric = None
-    try:
-        esa_image = ee.ImageCollection("ESA/WorldCover/v200").first().clip(aoi)
-        exclude_classes = [50, 60]  # 50 = Urban, 60 = Bare Sparse Vegetation
-        mask = ee.Image(1)
-        for cls in exclude_classes:
-            mask = mask.multiply(esa_image.select("Map").neq(cls))
-        esa_mask_resampled = mask.reproject(crs='EPSG:4326', scale=10)
-
-        url_esa = esa_mask_resampled.getDownloadURL({
-            'scale': 10,
-            'region': aoi,
-            'format': 'NPY'
-        })
-        r = requests.get(url_esa, stream=True)
-        if r.status_code == 200:
-            esa_np = np.load(BytesIO(r.content))
-            esa_mask_numeric = esa_np[esa_np.dtype.names[0]] if esa_np.dtype.names else esa_np
-            print("✅ ESA mask loaded.")
-        else:
-            print(f"❌ ESA mask HTTP error: {r.status_code}")
-    except Exception as e:
-        print(f"❌ ESA mask error: {e}")
+    dates = generate_dates(start_date, end_date, period)
+    esa_mask = build_esa_mask(aoi)
 
-    # Loop over dates
     for date in dates:
         date_str = date.strftime("%Y-%m-%d")
-        print(f"📅 Processing mask for {date_str}")
-        mask_np = None
-
-        try:
-            dw_image = ee.ImageCollection("GOOGLE/DYNAMICWORLD/V1") \
-                .filterBounds(aoi) \
-                .filterDate(date_str, (date + timedelta(days=30)).strftime("%Y-%m-%d")) \
-                .first()
-
-            if dw_image:
-                dw_image = dw_image.clip(aoi)
-
-                # ❌ Only exclude built area and bare ground (6 & 7)
-                exclude = [6, 7]
-                dw_mask = dw_image.select("label").neq(ee.Image.constant(exclude)).reduce(ee.Reducer.min())
-                binary_mask = dw_mask.eq(1).reproject(crs='EPSG:4326', scale=10)
-
-                url = binary_mask.getDownloadURL({
-                    'scale': 10,
-                    'region': aoi,
-                    'format': 'NPY'
-                })
-                r = requests.get(url, stream=True)
-                if r.status_code == 200:
-                    dlc_np = np.load(BytesIO(r.content))
-                    mask_np = dlc_np[dlc_np.dtype.names[0]] if dlc_np.dtype.names else dlc_np
-                    print(f"✅ DW mask loaded for {date_str}")
-                else:
-                    print(f"❌ DW HTTP error for {date_str}: {r.status_code}")
-            else:
-                print(f"⚠️ No DW image for {date_str}")
-
-        except Exception as e:
-            print(f"❌ DW error for {date_str}: {e}")
-
-        # Fallback to ESA if needed
-        if mask_np is None or np.all(mask_np == 0):
-            print(f"🟡 Using ESA fallback for {date_str}")
-            mask_np = esa_mask_numeric
-
-        if mask_np is not None:
-            masks[date_str] = mask_np
-        else:
-            print(f"❌ No mask available for {date_str}")
+        dw_collection = ee.ImageCollection("GOOGLE/DYNAMICWORLD/V1") \
+            .filterBounds(aoi) \
+            .filterDate(date_str, (date + timedelta(days=30)).strftime("%Y-%m-%d"))
+
+        dw_mask = build_dw_mask(dw_collection.first(), aoi)
+        masks[date_str] = ee.Image(ee.Algorithms.If(dw_collection.size().gt(0), dw_mask, esa_mask))
 
     return masks
@@ -1,25 +1,23 @@
 import os
 import sys
 import ee
-import json
-import time
 import rasterio
 import numpy as np
-import pandas as pd
 import google.auth
-from datetime import datetime, timedelta
 from google.cloud import storage
 
 # === Custom Modules ===
 from ee_preprocess import (
     load_and_validate_geojson,
-    get_square_encompassing_polygon,
+    get_square_encompassing_polygon_from_coords,
     create_data_cube,
-    get_dlc_mask_numpy
+    generate_dates,
+    get_dlc_mask,
+    DLC_NODATA
 )
 from rasterdiv_preprocess import (
-    load_raster,
-    raster_to_numpy,
+    GDAL_VSIGS_OPTIONS,
+    DISCRETE_NODATA,
     compute_shannon_entropy,
     compute_renyi_entropy,
     compute_rao_q,
@@ -27,12 +25,12 @@ from rasterdiv_preprocess import (
     compute_pixelwise_temporal_entropy
 )
 from ee_logistic import (
-    get_args,
-    initialize_gee,
+    EE_HIGHVOLUME_URL,
     export_image_to_gcs,
-    move_image_after_analysis,
-    save_as_geotiff
+    move_image_after_analysis
 )
+from cli import get_args
+from raster_io import save_as_geotiff
 
 # === Load Arguments ===
 args = get_args()
@@ -54,21 +52,23 @@ aoi_name = os.path.splitext(os.path.basename(geojson_path))[0]
 # === Initialize EE & GCS ===
 credentials, project = google.auth.default()
 storage_client = storage.Client(credentials=credentials, project=project)
-ee.Initialize(project='canopy-height-model-00')
+ee.Initialize(project='canopy-height-model-00', opt_url=EE_HIGHVOLUME_URL)
 
 # === 1. Load AOI ===
-aoi = load_and_validate_geojson(bucket_name, geojson_path)
-geometry = get_square_encompassing_polygon(aoi)
+aoi, aoi_coords = load_and_validate_geojson(bucket_name, geojson_path)
+geometry = get_square_encompassing_polygon_from_coords(aoi_coords)
 
-# === 2. Create NDVI DataCube ===
-data_cube = create_data_cube(geometry, start_date, end_date, period=frequency, indices=[selected_index])
+# === 2. Generate DLC Masks (server-side ee.Image per date) ===
+dlc_masks = get_dlc_mask(geometry, start_date, end_date, period=frequency)
 
-# === 3. Generate DLC Masks ===
-dlc_masks = get_dlc_mask_numpy(geometry, start_date, end_date, period=frequency)
+# === 3. Create NDVI DataCube, masked before export ===
+data_cube = create_data_cube(
+    geometry, start_date, end_date, period=frequency, indices=[selected_index], dlc_masks=dlc_masks, as_stack=True
+)
 
 # === 4. Export NDVI Cube ===
 datacube_filename = f"{selected_index}_datacube_{start_date}_{end_date}"
-export_image_to_gcs(data_cube.toBands(), input_folder, datacube_filename, bucket_name, geometry)
+export_image_to_gcs(data_cube, input_folder, datacube_filename, bucket_name, geometry)
 print(f"✅ Exported DataCube as {datacube_filename}")
 
 # === 5. Check GCS Export ===
@@ -83,87 +83,78 @@ if not image_names:
 
 print(f"✅ Found {len(image_names)} TIFF files. Processing entropy...")
 
-# === 6. Download Cube Locally ===
-datacube_path = f"gs://{bucket_name}/{input_folder}/{datacube_filename}.tif"
-local_tiff = f"/tmp/{datacube_filename}.tif"
-blob = bucket.blob(f"{input_folder}/{datacube_filename}.tif")
-blob.download_to_filename(local_tiff)
-print(f"✅ Downloaded DataCube to {local_tiff}")
+# === 6. Read Cube Directly from GCS (no local copy) ===
+datacube_path = f"/vsigs/{bucket_name}/{input_folder}/{datacube_filename}.tif"
+print(f"✅ Reading DataCube from {datacube_path}")
 
 # === 7. Per-Date Entropy Processing ===
-entropy_results = []
-dates = pd.date_range(start=start_date, end=end_date, freq=frequency)
+dates = generate_dates(start_date, end_date, frequency)
 
-with rasterio.open(local_tiff) as src:
+with rasterio.Env(**GDAL_VSIGS_OPTIONS), rasterio.open(datacube_path) as src:
     num_bands = src.count
     meta = src.meta.copy()
+
+    # Preallocated (T, H, W) outputs, filled in place band by band
+    index_cube = np.empty((num_bands, src.height, src.width), dtype=np.int16)
+    # Output TIFF bands: T per-date entropies + temporal + 3D, written in one call at the end
+    output_bands = np.empty((num_bands + 2, src.height, src.width), dtype=np.float32)
+    entropy_results = output_bands[:num_bands]  # View, no copy
+    timestep_array = np.empty((src.height, src.width), dtype=src.dtypes[0])  # Reused read buffer
+
     for i in range(num_bands):
         date_str = dates[i].strftime("%Y-%m-%d")
         print(f"📅 Processing time step {i + 1} - {date_str}")
 
-        timestep_array = src.read(i + 1)
-        timestep_array_discrete = np.round(timestep_array * 100).astype(int)
+        src.read(i + 1, out=timestep_array)
+        # Out-of-range values (e.g. EVI on near-zero denominators) saturate instead of wrapping in the int16 cast;
+        # the int16 minimum stays reserved for DISCRETE_NODATA
+        discrete = np.round(timestep_array * 100)
+        np.clip(discrete, DISCRETE_NODATA + 1, np.iinfo(np.int16).max, out=discrete)
 
-        if date_str in dlc_masks:
-            dlc_mask = np.array(dlc_masks[date_str], dtype=np.float32)
-            timestep_array_discrete[dlc_mask == 0] = 0
-            print(f"✅ Applied DLC mask for {date_str}")
-        else:
-            print(f"⚠️ No DLC mask for {date_str} – skipping masking.")
+        # DLC mask already applied by GEE: masked pixels carry DLC_NODATA and are skipped by the kernels,
+        # like NaN / inf pixels, which have no bin
+        masked = (timestep_array == DLC_NODATA) | ~np.isfinite(timestep_array)
+        index_cube[i] = np.where(masked, DISCRETE_NODATA, discrete)
+        timestep_array_discrete = index_cube[i]
 
         if entropy_measure == "shannon":
-            entropy_array = compute_shannon_entropy(timestep_array_discrete, window_size)
+            entropy_array = compute_shannon_entropy(timestep_array_discrete, window_size, nodata=DISCRETE_NODATA)
         elif entropy_measure == "renyi_0":
-            entropy_array = compute_renyi_entropy(timestep_array_discrete, alpha=0, window_size=window_size)
+            entropy_array = compute_renyi_entropy(timestep_array_discrete, alpha=0, window_size=window_size, nodata=DISCRETE_NODATA)
         elif entropy_measure == "renyi_2":
-            entropy_array = compute_renyi_entropy(timestep_array_discrete, alpha=2, window_size=window_size)
+            entropy_array = compute_renyi_entropy(timestep_array_discrete, alpha=2, window_size=window_size, nodata=DISCRETE_NODATA)
         elif entropy_measure == "rao_q":
-            entropy_array = compute_rao_q(timestep_array_discrete, window_size)
+            entropy_array = compute_rao_q(timestep_array_discrete, window_size, nodata=DISCRETE_NODATA)
         else:
             raise ValueError(f"❌ Invalid entropy measure: {entropy_measure}")
 
-        entropy_results.append(entropy_array)
-
-        if i == 0:
-            index_cube = [timestep_array_discrete]
-        else:
-            index_cube.append(timestep_array_discrete)
+        entropy_results[i] = entropy_array
 
 # === 8. Compute Extra Entropy Layers ===
-cube = np.stack(index_cube, axis=0).astype(np.float32)  # shape = (T, H, W)
-
 print("🧠 Computing 3D window-based entropy...")
-entropy_3d = compute_3d_window_entropy_map(
-    cube, spatial_window=window_size, entropy_type=entropy_measure
+output_bands[num_bands + 1] = compute_3d_window_entropy_map(
+    index_cube, spatial_window=window_size, entropy_type=entropy_measure, nodata=DISCRETE_NODATA
 )
 
 print("🧠 Computing temporal entropy...")
-temporal_entropy_map = compute_pixelwise_temporal_entropy(cube)
+output_bands[num_bands] = compute_pixelwise_temporal_entropy(index_cube, nodata=DISCRETE_NODATA)  # (T, H, W) int16, no stack/copy
 
 # === 9. Save All Entropy Bands to TIFF ===
 entropy_filename = f"{entropy_measure}_{selected_index}_{aoi_name}_{start_date}_{end_date}_w{window_size}.tif"
 entropy_tiff_path = f"/tmp/{entropy_filename}"
 
-with rasterio.open(
-    entropy_tiff_path, "w",
-    driver="GTiff",
-    height=entropy_results[0].shape[0],
-    width=entropy_results[0].shape[1],
-    count=num_bands + 2,
-    dtype=rasterio.float32,
-    crs=meta["crs"],
-    transform=meta["transform"]
-) as dst:
-    for i, (band, date) in enumerate(zip(entropy_results, dates)):
-        dst.write(band, i + 1)
-        dst.set_band_description(i + 1, f"{entropy_measure}_{date.strftime('%Y-%m-%d')}")
-
-    dst.write(temporal_entropy_map, num_bands + 1)
-    dst.set_band_description(num_bands + 1, f"{entropy_measure}_temporal_variability")
-
-    dst.write(entropy_3d, num_bands + 2)
-    dst.set_band_description(num_bands + 2, f"{entropy_measure}_3D_window_entropy")
-
+band_descriptions = [f"{entropy_measure}_{date.strftime('%Y-%m-%d')}" for date in dates[:num_bands]]
+band_descriptions += [f"{entropy_measure}_temporal_variability", f"{entropy_measure}_3D_window_entropy"]
+
+save_as_geotiff(
+    entropy_tiff_path, output_bands, meta,
+    overviews=(),
+    descriptions=band_descriptions,
+    blockxsize=512,
+    blockysize=512,
+    compress="zstd",
+    num_threads="ALL_CPUS"
+)
 print(f"✅ Saved Entropy DataCube as {entropy_tiff_path}")
 
 # === 10. Upload to GCS ===
@@ -1,23 +1,19 @@
-import os
 import sys
-import json
-import time
 import ee
 import rasterio
 import numpy as np
 import google.auth
-from datetime import datetime, timedelta
 from google.cloud import storage
 
 # ✅ Import custom functions
-from ee_preprocess import load_and_validate_geojson,create_composite, get_dlc_mask,get_square_encompassing_polygon,compute_indices,create_data_cube
-from rasterdiv_preprocess import load_raster,raster_to_numpy
-from ee_logistic import initialize_gee,export_image_to_gcs,move_image_after_analysis
+from ee_preprocess import load_and_validate_geojson,get_dlc_mask,get_square_encompassing_polygon_from_coords,create_data_cube,generate_dates,DLC_NODATA
+from rasterdiv_preprocess import download_raster,raster_to_numpy,iter_blocks,GDAL_ENV_OPTIONS
+from ee_logistic import EE_HIGHVOLUME_URL,export_image_to_gcs,move_image_after_analysis
 
 # ✅ Set up Google Cloud Storage and Earth Engine
 credentials, project = google.auth.default()
 storage_client = storage.Client(credentials=credentials, project=project)
-ee.Initialize(project='canopy-height-model-00')
+ee.Initialize(project='canopy-height-model-00', opt_url=EE_HIGHVOLUME_URL)
 
 # ✅ User-defined parameters
 bucket_name = "gchm-predictions-test"  # Update this
@@ -29,49 +25,58 @@ input_folder = "rasterdiv_data"  # Where exported images are stored
 output_folder = "rasterdiv_map"  # Where processed images are moved
 
 # ✅ 1. Load AOI from GeoJSON stored in GCS
-aoi = load_and_validate_geojson(bucket_name,geojson_path)
+aoi, aoi_coords = load_and_validate_geojson(bucket_name,geojson_path)
 
-# ✅ 2. Generate bounding box geometry
-geometry = get_square_encompassing_polygon(aoi)
+# ✅ 2. Generate bounding box geometry (computed locally from the GeoJSON coordinates)
+geometry = get_square_encompassing_polygon_from_coords(aoi_coords)
 
 # ✅ 3. Retrieve DLC masks (Dynamic World & ESA WorldCover)
-dlc_masks = get_dlc_mask(geometry, [date_range[0], date_range[1]])
+dlc_masks = get_dlc_mask(geometry, date_range[0], date_range[1], period=frequency)
 
-# ✅ 4. Create a time-series data cube with selected indices
-data_cube = create_data_cube(geometry, date_range[0], date_range[1], period=frequency, indices=indices)
+# ✅ 4. Create a time-series data cube with selected indices, masked server-side, stacked as one multiband image
+data_cube = create_data_cube(geometry, date_range[0], date_range[1], period=frequency, indices=indices, dlc_masks=dlc_masks, as_stack=True)
 
-# ✅ 5. Export each time step of the data cube to GCS
-image_list = data_cube.toList(data_cube.size())  # Keep this as an EE list
+# ✅ 5. Export the whole cube to GCS as a single multiband TIFF (one EE task instead of one per date)
+dates = generate_dates(date_range[0], date_range[1], frequency).strftime("%Y-%m-%d").tolist()
+file_name = f"{geojson_path.replace('.json', '').replace('/', '_').replace(' ', '_')}_{date_range[0]}_{date_range[1]}"
+export_image_to_gcs(data_cube, input_folder, file_name, bucket_name, geometry)
+print(f"✅ DataCube exported to gs://{bucket_name}/{input_folder}/{file_name}.tif")
 
-for i in range(data_cube.size().getInfo()):  # Get number of images
-    date = (datetime.strptime(date_range[0], "%Y-%m-%d") + timedelta(days=i * 10)).strftime("%Y-%m-%d")
-    file_name = f"{geojson_path.replace('.json', '').replace('/', '_').replace(' ', '_')}_{date}"
-    
-    # ✅ Retrieve the ee.Image correctly
-    image = ee.Image(image_list.get(i))  # Get the image from the list
-    
-    export_image_to_gcs(image,input_folder, file_name, bucket_name, geometry)
-    print(f"✅ Image for {date} exported to gs://{bucket_name}/Rasterdiv_data/{file_name}.tif")
 
-
-# ✅ 6. Verify exported images in GCS
+# ✅ 6. Verify exported image in GCS
 bucket = storage_client.bucket(bucket_name)
-blobs = bucket.list_blobs(prefix=f"{input_folder}/")
-image_names = [blob.name.replace(f"{input_folder}/", "") for blob in blobs if blob.name.endswith(".tif")]
+image_name = f"{file_name}.tif"
+if not bucket.blob(f"{input_folder}/{image_name}").exists():
+    print(f"❌ {image_name} not found in gs://{bucket_name}/{input_folder}/")
+    sys.exit(1)
 
 
-# ✅ 7. Process each exported Sentinel-2 image
-for image_name in image_names:
+# ✅ 7. Process each date of the exported cube, block by block to keep memory low
+with rasterio.Env(**GDAL_ENV_OPTIONS):
     print(f"🔄 Downloading and processing: {image_name}")
 
-    # ⬇️ Load the raster from GCS as a NumPy array
-    raster_array, meta = load_raster(f"gs://{bucket_name}/{input_folder}/{image_name}")
-    numpy_array = raster_to_numpy(raster_array, meta, set_nodata_to_nan=True)
+    # ⬇️ Download the raster from GCS
+    local_path = download_raster(f"gs://{bucket_name}/{input_folder}/{image_name}")
+    with rasterio.open(local_path) as src:
+        meta = {**src.meta, "nodata": DLC_NODATA}  # DLC-masked pixels are excluded from the stats
+
+    # toBands() stacks the bands date by date: each date owns a contiguous group of bands
+    bands_per_date = meta["count"] // len(dates)
+
+    for i, date in enumerate(dates):
+        date_bands = list(range(i * bands_per_date + 1, (i + 1) * bands_per_date + 1))
+
+        # Example: Print basic stats
+        raster_min, raster_max = np.nan, np.nan
+        for window, block in iter_blocks(local_path, indexes=date_bands):
+            block = raster_to_numpy(block, meta, set_nodata_to_nan=True)
+            raster_min = np.fmin(raster_min, np.fmin.reduce(block, axis=None))
+            raster_max = np.fmax(raster_max, np.fmax.reduce(block, axis=None))
 
-    # Example: Print basic stats
-    print(f"📊 Raster {image_name} - Shape: {numpy_array.shape}, Min: {np.nanmin(numpy_array)}, Max: {np.nanmax(numpy_array)}")
+        shape = (bands_per_date, meta["height"], meta["width"])
+        print(f"📊 Raster {image_name} [{date}] - Shape: {shape}, Min: {raster_min}, Max: {raster_max}")
 
-    # ✅ Move processed images to output folder
-    move_image_after_analysis(image_name, input_folder, output_folder, bucket_name)
+# ✅ Move processed image to output folder
+move_image_after_analysis(image_name, input_folder, output_folder, bucket_name)
 
 print("🎉 Processing complete!")
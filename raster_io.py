@@ -0,0 +1,52 @@
+import numpy as np
+import rasterio
+from rasterio.enums import Resampling
+
+
+def save_as_geotiff(output_path, raster_array, meta, overviews=(2, 4, 8, 16), descriptions=None, **creation_options):
+    """
+    Saves a raster array as a tiled, compressed GeoTIFF file with overviews.
+
+    Parameters:
+    - output_path: str, file path to save the GeoTIFF.
+    - raster_array: np.array, computed raster (e.g., entropy result), (H, W) or (bands, H, W).
+    - meta: dict, metadata from the original raster (crs, transform, etc.).
+    - overviews: tuple of int, overview decimation factors (empty to skip).
+    - descriptions: list of str, optional band descriptions.
+    - creation_options: GTiff options overriding the defaults below (e.g. compress="zstd").
+
+    Returns:
+    - None (saves file to disk).
+    """
+    raster_array = raster_array.astype(np.float32, copy=False)
+    if raster_array.ndim == 2:
+        raster_array = raster_array[np.newaxis]  # Single-band output
+
+    profile = dict(
+        driver="GTiff",
+        height=raster_array.shape[1],
+        width=raster_array.shape[2],
+        count=raster_array.shape[0],
+        dtype=rasterio.float32,  # Ensure floating-point precision
+        crs=meta["crs"],  # Keep original coordinate system
+        transform=meta["transform"],  # Keep original georeferencing
+        tiled=True,  # Internal tiling for windowed reads
+        blockxsize=256,
+        blockysize=256,
+        compress="deflate",
+        predictor=3,  # Floating-point predictor: smooth entropy rasters compress much better
+        BIGTIFF="IF_SAFER"
+    )
+    profile.update(creation_options)
+
+    with rasterio.open(output_path, "w", **profile) as dst:
+        dst.write(raster_array)  # All bands in a single call
+
+        for i, description in enumerate(descriptions or []):
+            dst.set_band_description(i + 1, description)
+
+        if overviews:
+            dst.build_overviews(list(overviews), Resampling.average)
+            dst.update_tags(ns="rio_overview", resampling="average")
+
+    print(f"✅ Raster saved as {output_path}")
@@ -1,23 +1,31 @@
-import os
 import rasterio
 import numpy as np
-import logging
+from functools import lru_cache
 from google.cloud import storage
-from scipy.stats import entropy
-from skimage.util.shape import view_as_windows
-from scipy.spatial.distance import pdist, squareform
-from scipy.ndimage import generic_filter
+from numba import njit, prange
 
-def load_raster(gcs_path):
+# GDAL settings for local raster reads: larger block cache and swath for block-wise I/O
+GDAL_ENV_OPTIONS = {"GDAL_CACHEMAX": 512, "GDAL_SWATH_SIZE": 268435456}
+
+# GDAL settings for reading rasters straight from GCS through /vsigs/ (no local copy):
+# authenticated requests, and no directory listing / sidecar probing on open
+GDAL_VSIGS_OPTIONS = {
+    **GDAL_ENV_OPTIONS,
+    "GS_NO_SIGN_REQUEST": "NO",
+    "GDAL_DISABLE_READDIR_ON_OPEN": "EMPTY_DIR",
+    "CPL_VSIL_CURL_ALLOWED_EXTENSIONS": ".tif",
+}
+
+
+def download_raster(gcs_path):
     """
-    Loads a raster from Google Cloud Storage (GCS) into Python.
+    Downloads a raster from Google Cloud Storage (GCS) to a local temporary file.
 
     Parameters:
     - gcs_path: str, full GCS path (e.g., "gs://your-bucket-name/DATASET_GEE_TIF/image.tif")
 
     Returns:
-    - raster_array: NumPy array of the raster
-    - meta: Metadata of the raster (projection, transform, etc.)
+    - local_path: str, path of the downloaded file
     """
     # Extract bucket name and blob name from GCS path
     gcs_path = gcs_path.replace("gs://", "")  # Remove "gs://" prefix
@@ -34,13 +42,45 @@ def load_raster(gcs_path):
 
     print(f"✅ Raster downloaded from GCS: {local_path}")
 
+    return local_path
+
+
+def load_raster(gcs_path):
+    """
+    Loads a raster from Google Cloud Storage (GCS) into Python.
+
+    Parameters:
+    - gcs_path: str, full GCS path (e.g., "gs://your-bucket-name/DATASET_GEE_TIF/image.tif")
+
+    Returns:
+    - raster_array: NumPy array of the raster
+    - meta: Metadata of the raster (projection, transform, etc.)
+    """
+    local_path = download_raster(gcs_path)
+
     # Open the raster with rasterio
     with rasterio.open(local_path) as src:
         raster_array = src.read()  # Read all bands as a NumPy array
         meta = src.meta  # Get metadata
 
     return raster_array, meta
-    
+
+
+def iter_blocks(path, indexes=1):
+    """
+    Iterates over a raster by its native block windows, so only one block is held in memory.
+
+    Parameters:
+    - path: str, raster path readable by rasterio
+    - indexes: int or list of int, band(s) to read (None for all bands)
+
+    Yields:
+    - (window, array) for each block
+    """
+    with rasterio.open(path) as src:
+        for _, window in src.block_windows(1):
+            yield window, src.read(indexes, window=window)
+
 
 def raster_to_numpy(raster_array, meta, set_nodata_to_nan=True):
     """
@@ -67,36 +107,207 @@ def raster_to_numpy(raster_array, meta, set_nodata_to_nan=True):
     return numpy_array
 
 
+# === 1. Sliding Window Histograms ===
+HIST_CHUNK_ELEMENTS = 1 << 24  # Histogram cells per chunk (~128 MB as int64)
+MASKED_BIN = 0  # Histogram bin of nodata (masked) pixels, emptied before every reduction
+DISCRETE_NODATA = np.iinfo(np.int16).min  # Nodata value of discretized (int16) index rasters
+
+
+def bin_values(values, nodata=None):
+    """
+    Value of each histogram bin of an integer raster or cube: histogram bin = rank of the value.
+
+    Bins are the distinct values, in increasing order, so an outlier adds a single bin instead
+    of stretching every histogram to the full value range. With nodata, masked pixels go to
+    MASKED_BIN and valid values start at bin 1. Distinct values are collected one row (2D) or
+    one band (3D) at a time, so no full-size copy of the input is made. Float inputs raise a
+    ValueError: the caller chooses how they are discretized (e.g. np.round(index * 100)).
+
+    Parameters:
+    - values: np.array of integer values
+    - nodata: int or None, value of masked pixels
+
+    Returns:
+    - np.array of the value of each bin, sorted (MASKED_BIN repeats the smallest value, its count is always emptied)
+    """
+    if not np.issubdtype(values.dtype, np.integer):
+        raise ValueError(f"❌ Entropy inputs must hold discrete (integer) values, got {values.dtype}: "
+                         "discretize them first (e.g. np.round(index * 100).astype(np.int16))")
+
+    distinct = np.unique(np.concatenate([np.unique(part) for part in values]))
+    if nodata is None:
+        return distinct
+
+    distinct = distinct[distinct != nodata]
+    if not distinct.size:  # Everything masked
+        return np.zeros(1, dtype=distinct.dtype)
+    return np.concatenate((distinct[:1], distinct))
+
+
+def bin_dtype(num_bins):
+    """Smallest integer dtype (int16 or int32) holding the bins 0..num_bins - 1."""
+    return np.int16 if num_bins <= np.iinfo(np.int16).max + 1 else np.int32
+
+
+def to_bins(values, bins_values, nodata=None):
+    """
+    Converts a block of integer values to int64 histogram bins (see bin_values).
+
+    Only the given block is converted, so callers convert one chunk at a time.
+    """
+    bins = np.searchsorted(bins_values, values, side='right') - 1  # Last bin <= value: skips the MASKED_BIN copy
+    if nodata is not None:
+        bins[values == nodata] = MASKED_BIN
+    return bins
+
+
+def bincount_rows(rows, num_bins):
+    """
+    Histogram of each row of a 2D array of non-negative integers, in a single np.bincount call.
+
+    Parameters:
+    - rows: np.array of shape (N, K), values in [0, num_bins)
+    - num_bins: int, number of histogram bins
+
+    Returns:
+    - hist: np.array of shape (N, num_bins)
+    """
+    n = rows.shape[0]
+    offsets = np.arange(n, dtype=np.int64)[:, None] * num_bins
+    return np.bincount((rows + offsets).ravel(), minlength=n * num_bins).reshape(n, num_bins)
+
+
+def sliding_window_reduce(image, window_size, reduce_histograms, nodata=None):
+    """
+    Applies a histogram reducer to every window_size x window_size window of an integer raster.
+
+    Windows are built with sliding_window_view (no copy) and histogrammed with bincount,
+    a block of rows at a time to bound memory. Edges are padded like generic_filter(mode='reflect').
+    Pixels equal to nodata are left out of every window (windows with no valid pixel give 0).
+
+    Parameters:
+    - image: np.array (H, W) of integer values
+    - window_size: int, size of the sliding window
+    - reduce_histograms: function mapping an (N, num_bins) histogram array and the bin values to N values
+    - nodata: int or None, value of masked pixels
+
+    Returns:
+    - result: np.array (H, W) float32
+    """
+    image = np.asarray(image)
+    values = bin_values(image, nodata)
+    num_bins = len(values)
+    H, W = image.shape
+
+    # Each pixel is converted to its bin once, into a compact copy of the raster that is then windowed
+    bins = to_bins(image, values, nodata).astype(bin_dtype(num_bins))
+    pad = window_size // 2
+    padded = np.pad(bins, pad, mode='symmetric')  # Same edges as generic_filter(mode='reflect')
+    windows = np.lib.stride_tricks.sliding_window_view(padded, (window_size, window_size))
+
+    result = np.empty((H, W), dtype=np.float32)
+    rows_per_chunk = max(1, HIST_CHUNK_ELEMENTS // (W * num_bins))
+    for start in range(0, H, rows_per_chunk):
+        chunk = windows[start:start + rows_per_chunk].reshape(-1, window_size * window_size)
+
+        # Constant (or fully masked) windows have entropy 0: only histogram the others
+        active = chunk.min(axis=1) != chunk.max(axis=1)
+        chunk_result = np.zeros(chunk.shape[0], dtype=np.float32)
+        if active.any():
+            hist = bincount_rows(chunk[active], num_bins)
+            if nodata is not None:
+                hist[:, MASKED_BIN] = 0
+            chunk_result[active] = reduce_histograms(hist, values)
+        result[start:start + rows_per_chunk] = chunk_result.reshape(-1, W)
+
+    return result
+
+
+def histogram_probabilities(hist):
+    """Normalizes each histogram row to probabilities (all zeros for an empty row)."""
+    total = hist.sum(axis=1, keepdims=True)
+    return np.divide(hist, total, out=np.zeros(hist.shape), where=total > 0)
+
+
+@lru_cache(maxsize=None)
+def xlog2x_table(max_count):
+    """Lookup table of k * log2(k) for the integer counts k = 0..max_count (0 for k = 0)."""
+    counts = np.arange(max_count + 1, dtype=np.float64)
+    table = np.zeros(max_count + 1, dtype=np.float64)
+    np.multiply(counts[1:], np.log2(counts[1:]), out=table[1:])
+    table.flags.writeable = False  # Shared between calls
+    return table
+
+
+def shannon_from_histograms(hist):
+    """
+    Shannon entropy (base 2) of each histogram row.
+
+    With N the row total, H = log2(N) - sum_k c_k log2(c_k) / N: the per-bin logs come
+    from a table of integer counts, leaving one log2 per row.
+    """
+    total = hist.sum(axis=1)
+    table = xlog2x_table(int(total.max()) if total.size else 0)
+    valid = total > 0  # Fully masked rows give 0
+    entropy = np.zeros(total.shape, dtype=np.float64)
+    entropy[valid] = np.log2(total[valid]) - table[hist[valid]].sum(axis=1) / total[valid]
+    return np.maximum(entropy, 0)  # Rounding can leave -1e-16 for single-value rows
+
+
+def renyi_from_histograms(hist, alpha):
+    """Rényi entropy of order alpha (natural log) of each histogram row, over the observed values."""
+    p = histogram_probabilities(hist)
+    p_alpha = np.zeros_like(p)
+    np.power(p, alpha, out=p_alpha, where=p > 0)
+    p_alpha_sum = p_alpha.sum(axis=1)
+    log_sum = np.zeros_like(p_alpha_sum)
+    np.log(p_alpha_sum, out=log_sum, where=p_alpha_sum > 0)  # Empty (fully masked) rows give 0
+    return (1 / (1 - alpha)) * log_sum
+
+
+def rao_q_from_histograms(hist, bins_values):
+    """
+    Rao's Q with absolute-difference distance of each histogram row.
+
+    Bins are sorted values (bins_values, see bin_values), so
+    sum_ij p_i p_j |v_i - v_j| = 2 * sum_i p_i (v_i * P_<i - S_<i),
+    with P_<i and S_<i the exclusive cumulative sums of p and p * v.
+    """
+    p = histogram_probabilities(hist)
+    v = np.asarray(bins_values, dtype=np.float64)
+    pv = p * v
+    p_below = np.cumsum(p, axis=1) - p
+    s_below = np.cumsum(pv, axis=1) - pv
+    return 2 * (pv * p_below - p * s_below).sum(axis=1)
+
+
 # === 2. Shannon Entropy Function ===
-def compute_shannon_entropy(image, window_size=7):
+def compute_shannon_entropy(image, window_size=7, nodata=None):
     """
     Computes Shannon entropy using a sliding window.
 
     Parameters:
-    - image: np.array, input raster
+    - image: np.array, input raster of discrete (integer) values
     - window_size: int, size of the sliding window
+    - nodata: int or None, value of masked pixels, excluded from the windows
 
     Returns:
     - entropy_raster: np.array, Shannon entropy map
     """
-    def shannon_entropy(window):
-        unique, counts = np.unique(window, return_counts=True)
-        probabilities = counts / counts.sum()
-        return entropy(probabilities, base=2) if len(probabilities) > 1 else 0
-
-    return generic_filter(image, shannon_entropy, size=window_size, mode='reflect')
+    return sliding_window_reduce(image, window_size, lambda hist, _: shannon_from_histograms(hist), nodata)
 
 # === 3. Rényi Entropy Function (Includes Shannon for α=1) ===
-def compute_renyi_entropy(image, alpha=2, window_size=7):
+def compute_renyi_entropy(image, alpha=2, window_size=7, nodata=None):
     """
     Computes Rényi entropy using a sliding window.
 
     If alpha = 1, the function defaults to Shannon entropy.
 
     Parameters:
-    - image: np.array, input raster
+    - image: np.array, input raster of discrete (integer) values
     - alpha: float, order parameter of Rényi entropy (α > 0, α ≠ 1)
     - window_size: int, size of the sliding window
+    - nodata: int or None, value of masked pixels, excluded from the windows
 
     Returns:
     - entropy_raster: np.array, Rényi entropy map
@@ -104,105 +315,168 @@ def compute_renyi_entropy(image, alpha=2, window_size=7):
     # if alpha == 1:
     #     return compute_shannon_entropy(image, window_size)
 
-    def renyi_entropy(window):
-        unique, counts = np.unique(window, return_counts=True)
-        probabilities = counts / counts.sum()
-        return (1 / (1 - alpha)) * np.log(np.sum(probabilities ** alpha)) if len(probabilities) > 1 else 0
-
-    return generic_filter(image, renyi_entropy, size=window_size, mode='reflect')
+    return sliding_window_reduce(image, window_size, lambda hist, _: renyi_from_histograms(hist, alpha), nodata)
 
 
 # === 4. Rao’s Quadratic Entropy Function (Rao Q) ===
-def compute_rao_q(image, window_size=7):
+def compute_rao_q(image, window_size=7, nodata=None):
     """
     Computes Rao’s quadratic entropy using a sliding window.
 
     Parameters:
-    - image: np.array, input raster
+    - image: np.array, input raster of discrete (integer) values
     - window_size: int, size of the sliding window
+    - nodata: int or None, value of masked pixels, excluded from the windows
 
     Returns:
     - rao_q_raster: np.array, Rao Q entropy map
     """
-    def rao_q(window):
-        unique, counts = np.unique(window, return_counts=True)
-        probabilities = counts / counts.sum()
-        distances = squareform(pdist(unique[:, None]))  # Distance matrix between unique values
-        return np.sum(probabilities[:, None] * probabilities[None, :] * distances) if len(probabilities) > 1 else 0
-
-    return generic_filter(image, rao_q, size=window_size, mode='reflect')
+    return sliding_window_reduce(image, window_size, rao_q_from_histograms, nodata)
 
 ### 3D entropies function , so we have an entropy map anyalizing spatial-temporal species variation
 
-def compute_3d_window_entropy_map(cube, spatial_window=3, entropy_type="shannon", alpha=2):
+ENTROPY_CODES = {"shannon": 0, "renyi_0": 1, "renyi_2": 1, "rao_q": 2}
+RENYI_ALPHAS = {"renyi_0": 0.0, "renyi_2": 2.0}
+
+
+@njit(parallel=True, fastmath=True, cache=True)
+def window_entropy_3d_kernel(padded, spatial_window, entropy_code, alpha, bins_values, skip_masked, log_table):
+    """
+    Numba kernel: entropy of the (T x W x W) window around each pixel of a padded cube of bins.
+
+    entropy_code: 0 = Shannon (base 2), 1 = Rényi of order alpha (natural log), 2 = Rao Q.
+    bins_values: float64 value of each bin (see bin_values), used by Rao Q for the distances.
+    skip_masked: leave bin 0 (MASKED_BIN) out of the window.
+    log_table: xlog2x_table of the window size, used by Shannon instead of one log2 per bin.
+    """
+    num_bins = bins_values.shape[0]
+    T = padded.shape[0]
+    H = padded.shape[1] - spatial_window + 1
+    W = padded.shape[2] - spatial_window + 1
+    window_total = T * spatial_window * spatial_window
+    result = np.zeros((H, W), dtype=np.float32)
+
+    for i in prange(H):
+        hist = np.zeros(num_bins, dtype=np.int32)  # Kept all-zero between windows
+        present = np.empty(num_bins, dtype=np.int64)
+        counts = np.empty(num_bins, dtype=np.int64)
+
+        for j in range(W):
+            lo = num_bins
+            hi = -1
+            for t in range(T):
+                for di in range(spatial_window):
+                    for dj in range(spatial_window):
+                        b = padded[t, i + di, j + dj]
+                        hist[b] += 1
+                        lo = min(lo, b)
+                        hi = max(hi, b)
+
+            if lo == hi:
+                hist[lo] = 0
+                continue  # Constant (or fully masked) window: entropy is 0
+
+            total = window_total
+            if skip_masked:
+                total -= hist[0]
+                hist[0] = 0
+
+            # Non-empty bins, in increasing value order, only scanned over [lo, hi] and reset on the way
+            k = 0
+            for b in range(lo, hi + 1):
+                if hist[b] > 0:
+                    present[k] = b
+                    counts[k] = hist[b]
+                    hist[b] = 0
+                    k += 1
+
+            if k <= 1:
+                continue  # A single value: entropy is 0
+
+            value = 0.0
+            if entropy_code == 0:
+                for n in range(k):
+                    value += log_table[counts[n]]
+                value = max(np.log2(total) - value / total, 0.0)
+            elif entropy_code == 1:
+                for n in range(k):
+                    value += (counts[n] / total) ** alpha
+                value = np.log(value) / (1.0 - alpha)
+            else:
+                # Rao Q = sum over all pairs of p_a * p_b * |v_a - v_b|
+                for a in range(k):
+                    p_a = counts[a] / total
+                    for b in range(a + 1, k):
+                        value += 2.0 * p_a * (counts[b] / total) * (bins_values[present[b]] - bins_values[present[a]])
+
+            result[i, j] = value
+
+    return result
+
+
+def compute_3d_window_entropy_map(cube, spatial_window=3, entropy_type="shannon", alpha=2, nodata=None):
     """
     Computes a 2D map of entropy per pixel, based on a 3D window (T x WxW) around each pixel.
 
     Parameters:
-        - cube: np.array of shape (T, H, W)
+        - cube: np.array of shape (T, H, W), discrete (integer) values
         - spatial_window: int (must be odd)
         - entropy_type: "shannon", "renyi_0", "renyi_2", or "rao_q"
         - alpha: float (used only for renyi variants)
+        - nodata: int or None, value of masked pixels, excluded from the windows
 
     Returns:
         - 2D entropy map of shape (H, W)
     """
-    from scipy.stats import entropy as shannon_entropy
-    from scipy.spatial.distance import pdist, squareform
+    if entropy_type not in ENTROPY_CODES:
+        raise ValueError("Invalid entropy type.")
 
+    cube = np.asarray(cube)
+    values = bin_values(cube, nodata)
     T, H, W = cube.shape
-    pad = spatial_window // 2
 
-    padded = np.pad(cube, ((0, 0), (pad, pad), (pad, pad)), mode='reflect')
-    result = np.zeros((H, W), dtype=np.float32)
-
-    for i in range(H):
-        for j in range(W):
-            window = padded[:, i:i+spatial_window, j:j+spatial_window]
-            values = window.flatten()
-            unique, counts = np.unique(values, return_counts=True)
-            probs = counts / counts.sum()
-
-            if len(probs) <= 1:
-                result[i, j] = 0
-                continue
-
-            if entropy_type == "shannon":
-                result[i, j] = shannon_entropy(probs, base=2)
-            elif entropy_type == "renyi_0":
-                result[i, j] = (1 / (1 - 0)) * np.log(np.sum(probs ** 0))  # will raise div by 0 if not caught
-            elif entropy_type == "renyi_2":
-                result[i, j] = (1 / (1 - 2)) * np.log(np.sum(probs ** 2))
-            elif entropy_type == "rao_q":
-                distances = squareform(pdist(unique[:, None]))
-                result[i, j] = np.sum(probs[:, None] * probs[None, :] * distances)
-            else:
-                raise ValueError("Invalid entropy type.")
+    # Bins are written band by band straight into the padded cube, in the smallest dtype that holds them
+    pad = spatial_window // 2
+    padded = np.empty((T, H + 2 * pad, W + 2 * pad), dtype=bin_dtype(len(values)))
+    for t in range(T):
+        padded[t] = np.pad(to_bins(cube[t], values, nodata), pad, mode='reflect')
 
-    return result
+    return window_entropy_3d_kernel(
+        padded, spatial_window, ENTROPY_CODES[entropy_type], RENYI_ALPHAS.get(entropy_type, alpha),
+        values.astype(np.float64), nodata is not None, xlog2x_table(T * spatial_window * spatial_window)
+    )
 
 
 
 ###Compute temporal entropy at each pixel location (H x W) over time (T).
 
-def compute_pixelwise_temporal_entropy(cube):
+def compute_pixelwise_temporal_entropy(cube, nodata=None):
     """
     Compute temporal entropy at each pixel location (H x W) over time (T).
 
+    Each pixel's time series is histogrammed with a single bincount per block of pixels
+    (no per-pixel Python loop), then reduced to Shannon entropy over the bin axis.
+
     Parameters:
-        cube: np.array of shape (T, H, W)
+        cube: np.array of shape (T, H, W), discrete (integer) values
+        nodata: int or None, value of masked pixels, left out of each time series
 
     Returns:
         2D array (H x W) of entropy values
     """
+    cube = np.asarray(cube)
+    values = bin_values(cube, nodata)
+    num_bins = len(values)
     T, H, W = cube.shape
-    result = np.zeros((H, W), dtype=np.float32)
-
-    for i in range(H):
-        for j in range(W):
-            time_series = cube[:, i, j]
-            values, counts = np.unique(time_series, return_counts=True)
-            probs = counts / counts.sum()
-            result[i, j] = entropy(probs, base=2) if len(probs) > 1 else 0
 
-    return result
\ No newline at end of file
+    flat = cube.reshape(T, H * W)
+    result = np.empty(H * W, dtype=np.float32)
+    pixels_per_chunk = max(1, HIST_CHUNK_ELEMENTS // num_bins)
+    for start in range(0, H * W, pixels_per_chunk):
+        series = to_bins(flat[:, start:start + pixels_per_chunk], values, nodata).T  # (pixels, T), only this block converted
+        hist = bincount_rows(series, num_bins)
+        if nodata is not None:
+            hist[:, MASKED_BIN] = 0
+        result[start:start + pixels_per_chunk] = shannon_from_histograms(hist)
+
+    return result.reshape(H, W)